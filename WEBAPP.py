@@ -1,37 +1,54 @@
 from __future__ import annotations
 
 import asyncio
-import base64
 import logging
 import math
+import pathlib
 import re
-import tempfile
+import time
 import dataclasses
-from datetime import datetime
+import functools
+import hashlib
 from typing import Optional
 
+import jinja2
 import quart
-from quart import render_template, request, make_response
+from quart import render_template, request, make_response, send_from_directory
+from quart.wrappers.response import FileBody
 from markupsafe import Markup, escape
 
 from config import *
 from src import errors
 from src.web.load import load
+from src.web.results import INPUT_HASH_SIZE, GeneratedTiles, ResultsCache
 from src.web.util import RenderTilesOptions, render_tiles
-from src.web.context import get_database, get_operation_macros, get_variant_handlers, teardown_appcontext
+from src.web import context
+from src.web.context import get_database, get_operation_macros, get_variant_handlers
 from src.web.middleware.path_prefix import RoutePrefixMiddleware
 
+class StreamedFileBody(FileBody):
+	# Files are streamed in chunks of this size. Quart's default of 8KiB is small for GIFs
+	buffer_size = 64 * 1024
+
+class Response(quart.Response):
+	file_body_class = StreamedFileBody
+
 app = quart.Quart(__name__,
 	template_folder="src/web/templates",
 	static_folder="src/web/static"
 )
+app.response_class = Response
+# Compiled templates are cached on disk, so new processes don't have to compile them again
+app.jinja_options = { **app.jinja_options, "bytecode_cache": jinja2.FileSystemBytecodeCache() }
 
 if webapp_route_prefix:
 	app.asgi_app = RoutePrefixMiddleware(app.asgi_app, prefix=webapp_route_prefix)
 
-@app.teardown_appcontext
-async def teardown(err):
-	await teardown_appcontext(err)
+app.logger.setLevel(
+	logging.DEBUG
+	if quart.helpers.get_debug_flag()
+	else logging.INFO
+)
 
 DISCORD_MARKDOWN_INLINE_CODE_REGEXP: re.Pattern = re.compile(r"`([^`]+?)`")
 
@@ -46,20 +63,29 @@ async def template_filter__replace_discord_markdown(value: str):
 	- `inline-code` => <code>inline-code</code>
 	"""
 
-	value = escape(value)
-	value = DISCORD_MARKDOWN_INLINE_CODE_REGEXP.sub(lambda m: f"<code>{m[1]}</code>", value)
+	# The template would be escaped too if substituted into Markup, so work on the escaped str instead
+	value = str(escape(value))
+	value = DISCORD_MARKDOWN_INLINE_CODE_REGEXP.sub(r"<code>\1</code>", value)
 	return Markup(value)
 
-load_done = False
+# Set once the data used for rendering has been loaded
+loaded = asyncio.Event()
+app.extensions["loaded"] = loaded
+
+LOADING_RETRY_AFTER = 30 # seconds
+loading_page: str | None = None
 
 def not_ready_fallback(f):
 	async def wrapper(*args, **kwargs):
-		global load_done
+		global loading_page
 
-		if load_done:
+		if loaded.is_set():
 			return await f(*args, **kwargs)
-		else:
-			return await render_template("loading.html")
+
+		# Doesn't depend on the request, so it's only rendered once
+		if loading_page is None:
+			loading_page = await render_template("loading.html", retry_after=LOADING_RETRY_AFTER)
+		return loading_page, 503, { "Retry-After": str(LOADING_RETRY_AFTER) }
 	return wrapper
 
 
@@ -74,57 +100,57 @@ def coerce_request_arg_to_int(value: str | None) -> int | None:
 	# "<integer>" => <integer>
 	# "<integer>.<decimals>" => <integer>
 	# "<non-number>" => None
-	try:
-		return int(value) if value is not None else None
-	except ValueError:
+	if not value:
 		return None
 
-@dataclasses.dataclass(frozen=True)
-class GeneratedTiles:
-	input_hash: int
-	tmp: tempfile.TemporaryFile
-	generated_at: datetime = dataclasses.field(default_factory=lambda: datetime.now())
-
-	@property
-	def result_url_hash(self) -> str:
-		input_hash_bytes = self.input_hash.to_bytes(length=8, byteorder="big", signed=True)
-		return base64.urlsafe_b64encode(input_hash_bytes).decode("utf-8")
+	integer, _, _ = value.partition(".")
+	digits = integer[1:] if integer[:1] in ("-", "+") else integer
+	return int(integer) if digits.isascii() and digits.isdigit() else None
 
-	@property
-	def expires_at(self) -> datetime:
-		return self.generated_at + webapp_max_result_life
-
-	def __hash__(self):
-		return self.input_hash
-
-	@staticmethod
-	def result_url_hash_to_input_hash(result_url_hash: str):
-		hash_bytes = base64.urlsafe_b64decode(result_url_hash.encode("utf-8"))
-		input_hash = int.from_bytes(hash_bytes, byteorder="big", signed=True)
-		return input_hash
-
-input_hash_to_generated_tiles_map: dict[int, GeneratedTiles] = {}
-
-scheduled_to_remove: set[str] = set()
+results_cache = ResultsCache(
+	pathlib.Path(webapp_results_path).resolve(),
+	max_life=webapp_max_result_life,
+	max_count=webapp_max_results,
+	max_size=webapp_max_results_size,
+	logger=app.logger
+)
+app.extensions["results_cache"] = results_cache
 
 @app.route("/results/<string:result_url_hash>.gif", methods=["GET"])
 async def results(result_url_hash: str):
-	input_hash = GeneratedTiles.result_url_hash_to_input_hash(result_url_hash)
-	generated_tiles = input_hash_to_generated_tiles_map.get(input_hash, None)
+	try:
+		input_hash = GeneratedTiles.result_url_hash_to_input_hash(result_url_hash)
+	except ValueError: # malformed base64
+		input_hash = None
+	generated_tiles = results_cache.get(input_hash)
 
 	if generated_tiles is None:
 		response = await make_response("Unknown hash")
 		response.status_code = 400
 		return response
 
+	# Result URLs are derived from their input, so the hash doubles as an ETag
+	etag = generated_tiles.result_url_hash
+	max_age = max(0, math.floor(generated_tiles.expires_at - time.monotonic()))
+
+	if etag in request.if_none_match:
+		# Skip the file entirely
+		response = await make_response("", 304)
+	else:
+		response = await send_from_directory(
+			results_cache.path,
+			generated_tiles.file_name,
+			mimetype="image/gif",
+			add_etags=False,
+			conditional=False,
+			cache_timeout=max_age
+		)
+		await response.make_conditional(request, accept_ranges=True, complete_length=generated_tiles.size)
 
-	blob = generated_tiles.tmp.read()
-	generated_tiles.tmp.seek(0)
-	scheduled_to_remove.add(input_hash)
-
-	response = await make_response(blob)
-	response.content_type = "image/gif"
-	response.cache_control.max_age = math.floor((generated_tiles.expires_at - datetime.now()).total_seconds())
+	response.set_etag(etag)
+	response.cache_control.public = True
+	response.cache_control.max_age = max_age
+	response.cache_control.immutable = True
 	return response
 
 @dataclasses.dataclass(frozen=True)
@@ -137,57 +163,100 @@ class WebappRenderTilesOptions:
 	delay: Optional[int] = None
 	frame_count: Optional[int] = None
 
-	def to_base_options(self):
-		opts = {}
-		if self.use_bg:
-			opts["background"] = (
-				self.bg_tx if self.bg_tx is not None else 1,
-				self.bg_ty if self.bg_ty is not None else 4
-			)
-		if self.palette is not None:
-			opts["palette"] = self.palette
-		if self.default_to_letters is not None:
-			opts["default_to_letters"] = self.default_to_letters
-		if self.delay is not None:
-			opts["delay"] = self.delay
-		if self.frame_count is not None:
-			opts["frame_count"] = self.frame_count
-
-		return RenderTilesOptions(**opts)
+	# (field name, RenderTilesOptions field name) of options that are passed through when set
+	_BASE_OPTIONS_FIELD_MAP = (
+		("palette", "palette"),
+		("default_to_letters", "default_to_letters"),
+		("delay", "delay"),
+		("frame_count", "frame_count")
+	)
+
+	@property
+	def base_options(self) -> RenderTilesOptions:
+		return to_base_options(self)
+
+	# (request arg name, coercion) of each field
+	_REQUEST_ARG_SPEC = (
+		("use_bg", coerce_request_arg_to_bool),
+		("bg_tx", coerce_request_arg_to_int),
+		("bg_ty", coerce_request_arg_to_int),
+		("palette", None),
+		("default_to_letters", coerce_request_arg_to_bool),
+		("delay", coerce_request_arg_to_int),
+		("frame_count", coerce_request_arg_to_int)
+	)
 
 	@classmethod
 	def from_request(Cls, request: quart.Request):
-		get = lambda name: request.args.get(name, None)
-
-		return Cls(
-			use_bg=coerce_request_arg_to_bool(get("use_bg")),
-			bg_tx=coerce_request_arg_to_int(get("bg_tx")),
-			bg_ty=coerce_request_arg_to_int(get("bg_ty")),
-			palette=get("palette"),
-			default_to_letters=coerce_request_arg_to_bool(get("default_to_letters")),
-			delay=coerce_request_arg_to_int(get("delay")),
-			frame_count=coerce_request_arg_to_int(get("frame_count"))
+		args = request.args
+
+		return Cls(**{
+			name: args.get(name, None) if coerce is None else coerce(args.get(name, None))
+			for name, coerce in Cls._REQUEST_ARG_SPEC
+		})
+
+# Both dataclasses are frozen, so equal options can share the same RenderTilesOptions instance,
+# even across requests. Kept out of the class, so the cache isn't tied to the instances it holds
+@functools.lru_cache(maxsize=512)
+def to_base_options(options: WebappRenderTilesOptions) -> RenderTilesOptions:
+	opts = {
+		base_name: value
+		for name, base_name in options._BASE_OPTIONS_FIELD_MAP
+		if (value := getattr(options, name)) is not None
+	}
+	if options.use_bg:
+		opts["background"] = (
+			options.bg_tx if options.bg_tx is not None else 1,
+			options.bg_ty if options.bg_ty is not None else 4
 		)
 
+	return RenderTilesOptions(**opts)
+
+def hash_input(prompt: str, options: WebappRenderTilesOptions) -> int:
+	# Unlike hash(), this is the same across processes and restarts, so results can outlive them
+	h = hashlib.blake2b(digest_size=INPUT_HASH_SIZE)
+	h.update(prompt.encode("utf-8"))
+	for field in dataclasses.fields(options):
+		h.update(b"\0")
+		h.update(repr(getattr(options, field.name)).encode("utf-8"))
+	return int.from_bytes(h.digest(), byteorder="big")
+
+@app.route("/metrics")
+async def metrics():
+	return {
+		"results": len(results_cache),
+		"results_max": results_cache.max_count,
+		"results_size": results_cache.total_size,
+		"results_max_size": results_cache.max_size,
+		**results_cache.stats
+	}
+
+# Variants and operations are defined in code, so their list pages are only rendered once
+list_pages: dict[str, str] = {}
+
 @app.route("/list/variants")
 async def list_variants():
-	all_variants = (await get_variant_handlers()).handlers
-	grouped_variants: dict[str, list[str]] = {}
-	for variant in all_variants:
-		group = variant.group or "Uncategorized"
-		if group not in grouped_variants:
-			grouped_variants[group] = []
-		grouped_variants[group].extend(variant.hints.values())
-	return await render_template("list_variants.html",
-		variants=grouped_variants
-	)
+	if "variants" not in list_pages:
+		all_variants = (await get_variant_handlers()).handlers
+		grouped_variants: dict[str, list[str]] = {}
+		for variant in all_variants:
+			group = variant.group or "Uncategorized"
+			if group not in grouped_variants:
+				grouped_variants[group] = []
+			grouped_variants[group].extend(variant.hints.values())
+		list_pages["variants"] = await render_template("list_variants.html",
+			variants=grouped_variants
+		)
+	return list_pages["variants"]
 
 @app.route("/list/operations")
 async def list_operations():
-	operation_macros = await get_operation_macros()
-	return await render_template("list_operations.html",
-		operations=operation_macros.get_all()
-	)
+	if "operations" not in list_pages:
+		operation_macros = await get_operation_macros()
+		list_pages["operations"] = await render_template("list_operations.html",
+			operations=operation_macros.get_all()
+		)
+	return list_pages["operations"]
 
 @app.route("/text", methods=["GET", "POST"])
 @not_ready_fallback
@@ -199,27 +268,27 @@ async def text():
 	status_code = 200
 
 	if prompt is not None:
-		input_hash = hash((prompt, options))
+		input_hash = hash_input(prompt, options)
+
+		generated_tiles = results_cache.get(input_hash)
+		if generated_tiles is None:
+			async def render():
+				r = await render_tiles(prompt, is_rule=True, options=options.base_options)
+				return r.buffer
 
-		if input_hash not in input_hash_to_generated_tiles_map:
 			try:
-				r = await render_tiles(prompt, is_rule=True, options=options.to_base_options())
-				buffer = r.buffer
+				generated_tiles = await results_cache.generate(input_hash, render)
 			except errors.WebappUserError as err:
 				error_msg = err.args[0]
 				status_code = 400
-			else:
-				tmp = tempfile.TemporaryFile("br+")
-				tmp.write(buffer.read())
-				tmp.seek(0)
-
-				generated_tiles = GeneratedTiles(
-					input_hash=input_hash,
-					tmp=tmp
-				)
-				input_hash_to_generated_tiles_map[input_hash] = generated_tiles
 		else:
-			generated_tiles = input_hash_to_generated_tiles_map[input_hash]
+			results_cache.stats["hits"] += 1
+
+	# Clients that only want the result can skip rendering the page
+	if request.accept_mimetypes.best_match(("text/html", "application/json")) == "application/json":
+		if error_msg is not None:
+			return { "error": error_msg }, status_code
+		return { "resultURLHash": generated_tiles.result_url_hash if generated_tiles is not None else None }, status_code
 
 	response = await make_response(await render_template("text.html",
 		prompt=prompt,
@@ -231,47 +300,60 @@ async def text():
 	return response
 
 async def do_load():
-	global load_done
-
-	load_done = False
+	loaded.clear()
 	async with app.app_context():
+		# Compile templates now, instead of on the first request that uses each of them.
+		# They don't depend on the data, so this happens on a thread while the data loads
+		compile_templates_task = asyncio.create_task(asyncio.to_thread(compile_templates))
+
 		db = await get_database()
 		await load(db)
-	load_done = True
 
-async def remove_scheduled_loop():
-	global scheduled_to_remove
+		await compile_templates_task
+	loaded.set()
 
-	while True:
-		await asyncio.sleep(1)
+def compile_templates():
+	for template_name in app.jinja_env.list_templates():
+		app.jinja_env.get_template(template_name)
 
-		now = datetime.now()
+background_tasks: set[asyncio.Task] = set()
 
-		new_scheduled_to_remove = { *scheduled_to_remove }
+def log_background_task_exception(task: asyncio.Task):
+	# Nothing awaits these until shutdown, so a failure would go unnoticed otherwise
+	# e.g. a failed load leaves the app not ready forever
+	if not task.cancelled() and (exc := task.exception()) is not None:
+		app.logger.error("Background task %s failed", task.get_name(), exc_info=exc)
 
-		for input_hash in scheduled_to_remove:
-			generated_tile = input_hash_to_generated_tiles_map[input_hash]
-			if now > generated_tile.expires_at:
-				app.logger.info(f"Removing {repr(generated_tile)}")
-				input_hash_to_generated_tiles_map.pop(input_hash)
-				generated_tile.tmp.close()
+@app.before_serving
+async def startup():
+	results_cache.prepare()
 
-				new_scheduled_to_remove.remove(input_hash)
+	# Started here rather than in __main__, so the app also works when served by an ASGI server
+	# e.g. `hypercorn WEBAPP:app`
+	for coro in (do_load(), results_cache.remove_scheduled_loop()):
+		task = asyncio.create_task(coro, name=coro.__qualname__)
+		task.add_done_callback(log_background_task_exception)
+		background_tasks.add(task)
 
-		scheduled_to_remove = new_scheduled_to_remove
+@app.after_serving
+async def shutdown():
+	app.logger.info("Shutting down...")
 
-if __name__ == "__main__":
-	loop = asyncio.new_event_loop()
-	asyncio.set_event_loop(loop)
+	for task in background_tasks:
+		task.cancel()
+	# Their exceptions have been logged by log_background_task_exception already
+	await asyncio.gather(*background_tasks, return_exceptions=True)
+	background_tasks.clear()
 
-	loop.create_task(do_load())
-	loop.create_task(remove_scheduled_loop())
+	await context.close()
 
-	app.logger.setLevel(
-		logging.DEBUG
-		if quart.helpers.get_debug_flag()
-		else logging.INFO
-	)
+if __name__ == "__main__":
+	try:
+		import uvloop
+	except ModuleNotFoundError:
+		pass # the default event loop works too, just slower
+	else:
+		asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 	try:
 		# TODO(netux): With this setup, the reloader in debug mode just exits the process.
@@ -279,13 +361,7 @@ if __name__ == "__main__":
 		app.run(
 			host=webapp_host,
 			port=webapp_port,
-			loop=loop,
 			use_reloader=False
 		)
 	except KeyboardInterrupt:
 		pass
-	finally:
-		app.logger.info("Shutting down...")
-		loop.stop()
-		loop.close()
-
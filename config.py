@@ -41,5 +41,8 @@ cogs = [
 webapp_host = "0.0.0.0"
 webapp_port = 5000
 webapp_max_result_life = timedelta(hours=1)
+webapp_results_path = "cache/results"
+webapp_max_results = 256
+webapp_max_results_size = 256 * 1024 * 1024 # bytes
 webapp_route_prefix = "/webapp-is-you"
 #endregion WEBAPP
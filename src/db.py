@@ -22,6 +22,9 @@ class Database:
         with open(f"data/hints/{BABA_WORLD}.json") as fp:
             self.level_hints = json.load(fp)
         self.conn = await asqlite.connect(db) # type: ignore
+        # asqlite already uses WAL, where this is still safe from corruption,
+        # and commits no longer wait for the disk
+        await self.conn.execute("PRAGMA synchronous = NORMAL")
         await self.create_tables()
 
     async def close(self) -> None:
@@ -171,6 +174,18 @@ class Database:
                 if row is not None:
                     yield TileData.from_row(row)
 
+    async def existing_tiles(self, names: Iterable[str], *, maximum_version: int = 1000) -> set[str]:
+        '''The names out of `names` that have tile data, in a single query.'''
+        names = list(names)
+        rows = await self.conn.fetchall(
+            f'''
+            SELECT DISTINCT name FROM tiles
+            WHERE name IN ({", ".join("?" * len(names))}) AND version <= ?;
+            ''',
+            *names, maximum_version
+        )
+        return {row[0] for row in rows}
+
     def plate(self, direction: int | None, wobble: int) -> tuple[Image.Image, tuple[int, int]]:
         '''Plate sprites. Raises FileNotFoundError on failure.'''
         if direction is None:
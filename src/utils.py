@@ -1,7 +1,13 @@
 from __future__ import annotations
+import os
+import re
+import weakref
+from functools import partial
+from operator import attrgetter
 from src.constants import BABA_WORLD
 
-from typing import Callable, Dict, List, Literal, Optional, TextIO, Tuple, TypeVar, overload
+from typing import Any, Callable, Dict, List, Literal, Optional, TextIO, Tuple, TypeVar, overload
+from lark import Lark, UnexpectedInput
 from PIL import Image
 
 class Tile:
@@ -38,4 +44,76 @@ def cached_open(path, *, cache: dict[str, T], fn: Callable[[str], T] = open) ->
     if path in cache:
         return cache[path]
     cache[path] = result = fn(path)
-    return result
\ No newline at end of file
+    return result
+
+def cached_parse_error(text: str, *, cache: dict[str, UnexpectedInput | None], parse: Callable[[str], Any]):
+    '''Raises the error from parsing `text`, only running the parser the first time. Meant as the `parse_fn` of `UnexpectedInput.match_examples`.'''
+    if text not in cache:
+        try:
+            parse(text)
+            cache[text] = None
+        except UnexpectedInput as e:
+            cache[text] = e
+    error = cache[text]
+    if error is not None:
+        # Without the traceback, so it doesn't grow every time it's raised
+        raise error.with_traceback(None)
+
+# Emoji replaced with their :text: representation
+BUILTIN_EMOJI = {
+    ord("\u24dc"): ":m:", # lower case circled m
+    ord("\u24c2"): ":m:", # upper case circled m
+    ord("\U0001f199"): ":up:", # up! emoji
+    ord("\U0001f637"): ":mask:", # mask emoji
+    ord("\ufe0f"): None
+}
+# Custom emoji (replaced with their :text: representation), and code blocks, backslashes and backticks (removed)
+CLEANUP_REGEXP: re.Pattern = re.compile(r'<a?(:[a-zA-Z0-9_]{2,32}:)\d{1,21}>|```\n|[\\`]')
+
+# Background, palette, raw, letter, delay and frames flags, in that order
+FLAG_REGEXPS: tuple[re.Pattern, ...] = tuple(re.compile(pattern) for pattern in (
+    r"(?:^|\s)(?:--background|-b)(?:=(\d)/(\d))?(?:$|\s)",
+    r"(?:^|\s)(?:--palette=|-p=|palette:)(\w+)(?:$|\s)",
+    r"(?:^|\s)(?:--raw|-r)(?:=([a-zA-Z_0-9]+))?(?:$|\s)",
+    r"(?:^|\s)(?:--letter|-l)(?:$|\s)",
+    r"(?:^|\s)(?:(--delay=|-d=)(\d+))(?:$|\s)",
+    r"(?:^|\s)(?:(--frames=|-f=)(\d))(?:$|\s)",
+))
+
+# Reads the string out of a lark Token
+TOKEN_VALUE = attrgetter("value")
+
+# Labels for common syntax errors, by example inputs that cause them
+MISTAKE_EXAMPLES = {
+    "unclosed": [
+        "(baba",
+        "[this ",
+        "\"rule",
+    ],
+    "missing": [
+        ":red",
+        "baba :red",
+        "&baba",
+        "baba& keke",
+        ">baba",
+        "baba> keke"
+    ],
+    "variant": [
+        "baba: keke",
+    ]
+}
+# Parse errors of the examples, by the parser that raised them, so they're only parsed once
+_mistake_example_errors: weakref.WeakKeyDictionary[Lark, dict[str, UnexpectedInput | None]] = weakref.WeakKeyDictionary()
+def match_mistake(error: UnexpectedInput, parser: Lark) -> str | None:
+    '''Which of `MISTAKE_EXAMPLES` the error from `parser` is like, if any.'''
+    cache = _mistake_example_errors.setdefault(parser, {})
+    return error.match_examples(partial(cached_parse_error, cache=cache, parse=parser.parse), MISTAKE_EXAMPLES)
+
+_palette_names: tuple[float, frozenset[str]] | None = None
+def palette_names() -> frozenset[str]:
+    '''File names of the palettes in `data/palettes`. Listed again only when the directory changes.'''
+    global _palette_names
+    mtime = os.stat("data/palettes").st_mtime
+    if _palette_names is None or _palette_names[0] != mtime:
+        _palette_names = mtime, frozenset(os.listdir("data/palettes"))
+    return _palette_names[1]
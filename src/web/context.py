@@ -1,4 +1,5 @@
-from quart import g
+import asyncio
+
 from lark import Lark
 
 from ..db import Database
@@ -8,44 +9,68 @@ from ..cogs.render import Renderer
 
 from config import db_path
 
+# Parsing doesn't change the parser, so a single one is shared.
+# cache=True stores the generated tables, so later processes don't have to build them again
+with open("src/tile_grammar.lark") as _f:
+	lark_parser = Lark(_f.read(), start="row", parser="lalr", cache=True)
+
+# Created once and shared by every request, like the bot does
+_database: Database | None = None
+_database_lock = asyncio.Lock()
+_operation_macros: OperationMacros | None = None
+_variant_handlers: VariantHandlers | None = None
+_renderer: Renderer | None = None
+
 async def get_database() -> Database:
-	if 'db' not in g:
-		g.db = Database()
-		await g.db.connect(db_path)
+	global _database
+
+	if _database is None:
+		# Connecting yields to the event loop, so concurrent first calls could connect twice otherwise
+		async with _database_lock:
+			if _database is None:
+				database = Database()
+				await database.connect(db_path)
+				_database = database
 
-	return g.db
+	return _database
 
 async def get_operation_macros() -> OperationMacros:
-	if 'operation_macros' not in g:
-		g.operation_macros = OperationMacros()
-		setup_default_macros(g.operation_macros)
+	global _operation_macros
 
-	return g.operation_macros
+	if _operation_macros is None:
+		_operation_macros = OperationMacros()
+		setup_default_macros(_operation_macros)
+
+	return _operation_macros
 
 async def get_variant_handlers() -> VariantHandlers:
-	if 'variant_handlers' not in g:
-		g.variant_handlers = VariantHandlers(await get_database())
-		setup_default_variant_handlers(g.variant_handlers)
+	global _variant_handlers
+
+	database = await get_database()
+	if _variant_handlers is None:
+		_variant_handlers = VariantHandlers(database)
+		setup_default_variant_handlers(_variant_handlers)
 
-	return g.variant_handlers
+	return _variant_handlers
 
 async def get_renderer() -> Renderer:
-	if 'renderer' not in g:
-		g.renderer = Renderer(await get_database())
+	global _renderer
 
-	return g.renderer
+	database = await get_database()
+	if _renderer is None:
+		_renderer = Renderer(database)
 
-async def get_lark_parser() -> Lark:
-	if 'lark' not in g:
-		with open("src/tile_grammar.lark") as _f:
-			g.lark = Lark(_f.read(), start="row", parser="lalr")
+	return _renderer
 
-	return g.lark
+async def get_lark_parser() -> Lark:
+	return lark_parser
 
 # ---
 
-async def teardown_appcontext(_err):
-	if 'db' in g:
-		db: Database = g.db
-		await db.close()
+async def close():
+	global _database, _variant_handlers, _renderer
 
+	if _database is not None:
+		await _database.close()
+		# Both hold on to the database
+		_database = _variant_handlers = _renderer = None
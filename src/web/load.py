@@ -1,56 +1,45 @@
-import collections
+import asyncio
 import configparser
 import itertools
 import json
 import logging
+import os
 import re
 import io
 import pathlib
+import numpy as np
 from PIL import Image, ImageChops, ImageDraw
 from typing import Any, Callable
 
 from quart import current_app
 
 from .. import constants
-from ..db import Database, TileData
+from ..db import Database
 
 def get_logger():
 	return current_app.logger if current_app else logging.getLogger(__name__)
 
 class LoadFlagHandlers:
+	__slots__ = ("flag", "description", "fn")
+
 	def __init__(self, flag: str, description: str, fn: Callable) -> None:
 		self.flag: str = flag
 		self.description: str = description
 		self.fn: Callable = fn
 
-	async def __call__(self, db: Database, *args, skip_flag_check: bool = False, **kwargs):
+	async def __call__(self, db: Database, *args, set_flags: set[str], skip_flag_check: bool = False, **kwargs):
+		'''`set_flags` are the load flags set on the database. This loader's flag is added to it once it's done.'''
 		logger = get_logger()
 
-		if not skip_flag_check:
-			async with db.conn.cursor() as cur:
-				await cur.execute(
-					'''
-					SELECT true FROM load_flags
-					WHERE flag = ?
-					''',
-					(self.flag,)
-				)
-				skip_load = await cur.fetchone()
-
-			if skip_load:
-				logger.info(f"Skipping load of {self.description} as load flag {self.flag} is set on the database")
-				return
+		if not skip_flag_check and self.flag in set_flags:
+			logger.info("Skipping load of %s as load flag %s is set on the database", self.description, self.flag)
+			return
 
-		logger.info(f"Loading {self.description}")
+		logger.info("Loading %s", self.description)
 		await self.fn(db, *args, **kwargs)
-		logger.info(f"Loaded {self.description}")
+		logger.info("Loaded %s", self.description)
 
-		await db.conn.execute(
-			'''
-			INSERT OR IGNORE INTO load_flags VALUES (?)
-			''',
-			(self.flag,)
-		)
+		set_flags.add(self.flag)
 
 def with_load_flag(flag: str, description: str):
 	def wrapper(fn: Callable):
@@ -59,13 +48,39 @@ def with_load_flag(flag: str, description: str):
 
 #region Tiles
 
+# Object definitions in `data/values.lua` and `data/editor_objectlist.lua`
+VALUES_OBJECT_REGEXP: re.Pattern = re.compile(
+	r"(object\d+) =\n\t\{"
+	r"\n\s*name = \"([^\"]*)\","
+	r"\n\s*sprite = \"([^\"]*)\","
+	r"\n.*\n.*\n\s*tiling = (-1|\d),"
+	r"\n\s*type = (\d),"
+	r"\n\s*(?:argextra = .*,\n\s*)?(?:argtype = .*,\n\s*)?"
+	r"colour = \{(\d), (\d)\},"
+	r"\n\s*(?:active = \{(\d), (\d)\},\n\s*)?"
+	r".*\n.*\n.*\n\s*\}",
+)
+
+EDITOR_OBJECT_REGEXP: re.Pattern = re.compile(
+	r"\[\d+\] = \{"
+	r"\n\s*name = \"([^\"]*)\","
+	r"(?:\n\s*sprite = \"([^\"]*)\",)?"
+	r"\n.*"
+	r"\n\s*tags = \{((?:\"[^\"]*?\"(?:,\"[^\"]*?\")*)?)\},"
+	r"\n\s*tiling = (-1|\d),"
+	r"\n\s*type = (\d),"
+	r"\n.*"
+	r"\n\s*colour = \{(\d), (\d)\},"
+	r"(?:\n\s*colour_active = \{(\d), (\d)\})?"
+)
+EDITOR_TAG_REGEXP: re.Pattern = re.compile(r"\"[^\"]*?\"") # quotes included
+
 @with_load_flag(flag="tiles.initial", description="initial tiles")
 async def load_initial_tiles(db: Database):
 	'''Loads tile data from `data/values.lua` and `.ld` files.'''
 
 	# values.lua contains the data about which color (on the palette) is associated with each tile.
-	with open("data/values.lua", encoding="utf-8", errors="replace") as fp:
-		data = fp.read()
+	data = await asyncio.to_thread(pathlib.Path("data/values.lua").read_text, encoding="utf-8", errors="replace")
 
 	start = data.find("tileslist =\n")
 	end = data.find("\n}\n", start)
@@ -89,19 +104,8 @@ async def load_initial_tiles(db: Database):
 			d["active_color_y"] = int(active[1])
 		return d
 
-	object_pattern = re.compile(
-		r"(object\d+) =\n\t\{"
-		r"\n\s*name = \"([^\"]*)\","
-		r"\n\s*sprite = \"([^\"]*)\","
-		r"\n.*\n.*\n\s*tiling = (-1|\d),"
-		r"\n\s*type = (\d),"
-		r"\n\s*(?:argextra = .*,\n\s*)?(?:argtype = .*,\n\s*)?"
-		r"colour = \{(\d), (\d)\},"
-		r"\n\s*(?:active = \{(\d), (\d)\},\n\s*)?"
-		r".*\n.*\n.*\n\s*\}",
-	)
 	initial_objects: dict[str, dict[str, Any]] = {}
-	for match in re.finditer(object_pattern, spanned):
+	for match in VALUES_OBJECT_REGEXP.finditer(spanned):
 		obj, name, sprite, tiling, type, c_x, c_y, a_x, a_y = match.groups()
 		if a_x is None or a_y is None:
 			inactive_x = active_x = int(c_x)
@@ -124,24 +128,37 @@ async def load_initial_tiles(db: Database):
 			active_color_y=active_y,
 		)
 
-	changed_objects: list[dict[str, Any]] = []
-	for path in pathlib.Path(f"data/levels/{constants.BABA_WORLD}").glob("*.ld"):
-
-		parser = configparser.ConfigParser()
+	def read_changed_objects(path: pathlib.Path) -> list[dict[str, Any]]:
+		'''Objects changed by a level'''
+		# Values are never interpolated, and the section is read once instead of on every lookup
+		parser = configparser.RawConfigParser()
 		parser.read(path, encoding="utf-8")
-		changed_ids = parser.get("tiles", "changed", fallback=",").split(",")[:-1]
+		tiles = dict(parser.items("tiles")) if parser.has_section("tiles") else {}
+		changed_ids = tiles.get("changed", ",").split(",")[:-1]
 
+		changed_objects: list[dict[str, Any]] = []
 		fields = ("name", "image", "tiling", "colour", "activecolour", "type")
 		for id in changed_ids:
 			changes: dict[str, Any] = {}
 			for field in fields:
-				change = parser.get("tiles", f"{id}_{field}", fallback=None)
+				# Option names are lowercased when read
+				change = tiles.get(parser.optionxform(f"{id}_{field}"), None)
 				if change is not None:
 					changes[field] = change
 			# Ignore blank changes (identical to values.lua objects)
 			# Ignore changes without a name (the same name but a different color, etc)
 			if changes and changes.get("name") is not None:
 				changed_objects.append({**initial_objects[id], **prepare(changes)})
+		return changed_objects
+
+	# Levels are read on threads, so the event loop can keep going meanwhile.
+	# gather() keeps them in the same order, which matters for breaking ties below
+	changed_objects: list[dict[str, Any]] = []
+	for level_changed_objects in await asyncio.gather(*(
+		asyncio.to_thread(read_changed_objects, path)
+		for path in pathlib.Path(f"data/levels/{constants.BABA_WORLD}").glob("*.ld")
+	)):
+		changed_objects.extend(level_changed_objects)
 
 	with open("config/editortileignore.json") as f:
 		ignored_names = json.load(f)
@@ -151,11 +168,18 @@ async def load_initial_tiles(db: Database):
 	))
 	ready: list[dict[str, Any]] = []
 	for name, duplicates in by_name:
-		def freeze_dict(d: dict[str, Any]) -> tuple[tuple[str, Any], ...]:
-			'''Hashable (frozen) dict'''
-			return tuple(d.items())
-		counts = collections.Counter(map(freeze_dict, duplicates))
-		most_common, _ = counts.most_common(1)[0]
+		duplicates = list(duplicates)
+		# Most tiles only change once, so there's nothing to count
+		if len(duplicates) == 1:
+			ready.append(duplicates[0])
+			continue
+
+		# Ties go to the first one seen, like Counter.most_common() would
+		counts: dict[tuple[tuple[str, Any], ...], int] = {}
+		for duplicate in duplicates:
+			frozen = tuple(duplicate.items()) # hashable
+			counts[frozen] = counts.get(frozen, 0) + 1
+		most_common = max(counts, key=counts.__getitem__)
 		ready.append(dict(most_common))
 
 	await db.conn.executemany(
@@ -224,29 +248,15 @@ async def load_initial_tiles(db: Database):
 async def load_editor_tiles(db: Database):
 	'''Loads tile data from `data/editor_objectlist.lua`.'''
 
-	with open("data/editor_objectlist.lua", encoding="utf-8", errors="replace") as fp:
-		data = fp.read()
+	data = await asyncio.to_thread(pathlib.Path("data/editor_objectlist.lua").read_text, encoding="utf-8", errors="replace")
 
 	start = data.find("editor_objlist = {")
 	end = data.find("\n}", start)
 	assert start > 0 and end > 0
 	spanned = data[start:end]
 
-	object_pattern = re.compile(
-		r"\[\d+\] = \{"
-		r"\n\s*name = \"([^\"]*)\","
-		r"(?:\n\s*sprite = \"([^\"]*)\",)?"
-		r"\n.*"
-		r"\n\s*tags = \{((?:\"[^\"]*?\"(?:,\"[^\"]*?\")*)?)\},"
-		r"\n\s*tiling = (-1|\d),"
-		r"\n\s*type = (\d),"
-		r"\n.*"
-		r"\n\s*colour = \{(\d), (\d)\},"
-		r"(?:\n\s*colour_active = \{(\d), (\d)\})?"
-	)
-	tag_pattern = re.compile(r"\"([^\"]*?)\"")
 	objects = []
-	for match in re.finditer(object_pattern, spanned):
+	for match in EDITOR_OBJECT_REGEXP.finditer(spanned):
 		name, sprite, raw_tags, tiling, text_type, c_x, c_y, a_x, a_y = match.groups()
 		sprite = name if sprite is None else sprite
 		a_x = c_x if a_x is None else a_x
@@ -257,10 +267,7 @@ async def load_editor_tiles(db: Database):
 		inactive_y = int(c_y)
 		tiling = int(tiling)
 		text_type = int(text_type)
-		tag_list = []
-		for tag in re.finditer(tag_pattern, raw_tags):
-			tag_list.append(tag.group(0))
-		tags = "\t".join(tag_list)
+		tags = "\t".join(EDITOR_TAG_REGEXP.findall(raw_tags))
 
 		objects.append(dict(
 			name=name,
@@ -328,78 +335,83 @@ async def load_custom_tiles(db: Database):
 		d["tags"] = d.get("tags", "")
 		return d
 
-	async with db.conn.cursor() as cur:
+	def read_objects() -> list[dict[str, Any]]:
+		objects: list[dict[str, Any]] = []
 		for path in pathlib.Path("data/custom").glob("*.json"):
 			source = path.parts[-1].split(".")[0]
 			with open(path, errors="replace", encoding="utf-8") as fp:
-				objects = [prepare(source, obj) for obj in json.load(fp)]
-
-			await cur.executemany(
-				'''
-				INSERT INTO tiles
-				VALUES (
-					:name,
-					:sprite,
-					:source,
-					2,
-					:inactive_color_x,
-					:inactive_color_y,
-					:active_color_x,
-					:active_color_y,
-					:tiling,
-					:text_type,
-					:text_direction,
-					:tags
-				)
-				ON CONFLICT(name, version)
-				DO UPDATE SET
-					sprite=excluded.sprite,
-					source=excluded.source,
-					inactive_color_x=excluded.inactive_color_x,
-					inactive_color_y=excluded.inactive_color_y,
-					active_color_x=excluded.active_color_x,
-					active_color_y=excluded.active_color_y,
-					tiling=excluded.tiling,
-					text_type=excluded.text_type,
-					text_direction=excluded.text_direction,
-					tags=excluded.tags;
-				''',
-				objects
+				objects.extend(prepare(source, obj) for obj in json.load(fp))
+		return objects
+	objects = await asyncio.to_thread(read_objects)
+	# this is a mega HACK, but I'm keeping it because the alternative is a headache
+	hacks = [x for x in objects if "baba_special" in x["tags"].split("\t")]
+
+	# All files go in at once, in a single transaction. Otherwise each row is committed on its own
+	async with db.conn.cursor(transaction=True) as cur:
+		await cur.executemany(
+			'''
+			INSERT INTO tiles
+			VALUES (
+				:name,
+				:sprite,
+				:source,
+				2,
+				:inactive_color_x,
+				:inactive_color_y,
+				:active_color_x,
+				:active_color_y,
+				:tiling,
+				:text_type,
+				:text_direction,
+				:tags
 			)
-			# this is a mega HACK, but I'm keeping it because the alternative is a headache
-			hacks = [x for x in objects if "baba_special" in x["tags"].split("\t")]
-			await cur.executemany(
-				'''
-				INSERT INTO tiles
-				VALUES (
-					:name,
-					:sprite,
-					:source,
-					0,
-					:inactive_color_x,
-					:inactive_color_y,
-					:active_color_x,
-					:active_color_y,
-					:tiling,
-					:text_type,
-					:text_direction,
-					:tags
-				)
-				ON CONFLICT(name, version)
-				DO UPDATE SET
-					sprite=excluded.sprite,
-					source=excluded.source,
-					inactive_color_x=excluded.inactive_color_x,
-					inactive_color_y=excluded.inactive_color_y,
-					active_color_x=excluded.active_color_x,
-					active_color_y=excluded.active_color_y,
-					tiling=excluded.tiling,
-					text_type=excluded.text_type,
-					text_direction=excluded.text_direction,
-					tags=excluded.tags;
-				''',
-				hacks
+			ON CONFLICT(name, version)
+			DO UPDATE SET
+				sprite=excluded.sprite,
+				source=excluded.source,
+				inactive_color_x=excluded.inactive_color_x,
+				inactive_color_y=excluded.inactive_color_y,
+				active_color_x=excluded.active_color_x,
+				active_color_y=excluded.active_color_y,
+				tiling=excluded.tiling,
+				text_type=excluded.text_type,
+				text_direction=excluded.text_direction,
+				tags=excluded.tags;
+			''',
+			objects
+		)
+		await cur.executemany(
+			'''
+			INSERT INTO tiles
+			VALUES (
+				:name,
+				:sprite,
+				:source,
+				0,
+				:inactive_color_x,
+				:inactive_color_y,
+				:active_color_x,
+				:active_color_y,
+				:tiling,
+				:text_type,
+				:text_direction,
+				:tags
 			)
+			ON CONFLICT(name, version)
+			DO UPDATE SET
+				sprite=excluded.sprite,
+				source=excluded.source,
+				inactive_color_x=excluded.inactive_color_x,
+				inactive_color_y=excluded.inactive_color_y,
+				active_color_x=excluded.active_color_x,
+				active_color_y=excluded.active_color_y,
+				tiling=excluded.tiling,
+				text_type=excluded.text_type,
+				text_direction=excluded.text_direction,
+				tags=excluded.tags;
+			''',
+			hacks
+		)
 
 #endregion Tiles
 
@@ -411,24 +423,43 @@ async def _load_ready_letters(db: Database):
 			return im
 		elif im.mode == "RGB" or im.mode == "L":
 			return im.convert("1")
+		elif im.mode == "RGBA" or im.mode == "LA":
+			# The alpha channel can be taken as is, without going through a full RGBA copy
+			return im.getchannel("A").convert("1")
 		return im.convert("RGBA").getchannel("A").convert("1")
-	data = []
-	for path in pathlib.Path("data/letters").glob("*/*/*/*_0.png"):
+	def encode(path: pathlib.Path) -> bytes:
+		buf = io.BytesIO()
+		# Closes the file as soon as it's read
+		with Image.open(path) as im:
+			channel_shenanigans(im).save(buf, format="PNG")
+		return buf.getvalue()
+	def read_letter(path: pathlib.Path) -> tuple[str, str, int, bytes, bytes, bytes]:
 		_, _, mode, char, w, name = path.parts
 		char = char.replace("asterisk", "*")
 		width = int(w)
 		prefix = name[:-6]
 		# mo ch w h
-		buf_0 = io.BytesIO()
-		channel_shenanigans(Image.open(path)).save(buf_0, format="PNG")
-		blob_0 = buf_0.getvalue()
-		buf_1 = io.BytesIO()
-		channel_shenanigans(Image.open(path.parent / f"{prefix}_1.png")).save(buf_1, format="PNG")
-		blob_1 = buf_1.getvalue()
-		buf_2 = io.BytesIO()
-		channel_shenanigans(Image.open(path.parent / f"{prefix}_2.png")).save(buf_2, format="PNG")
-		blob_2 = buf_2.getvalue()
-		data.append((mode, char, width, blob_0, blob_1, blob_2))
+		blob_0 = encode(path)
+		blob_1 = encode(path.parent / f"{prefix}_1.png")
+		blob_2 = encode(path.parent / f"{prefix}_2.png")
+		return (mode, char, width, blob_0, blob_1, blob_2)
+	def first_frame_paths() -> list[pathlib.Path]:
+		'''`data/letters/<mode>/<char>/<width>/*_0.png`, walked once without globbing'''
+		def subdirs(path: str) -> list[os.DirEntry]:
+			with os.scandir(path) as it:
+				return [entry for entry in it if entry.is_dir()]
+		paths = []
+		for mode_dir in subdirs("data/letters"):
+			for char_dir in subdirs(mode_dir.path):
+				for width_dir in subdirs(char_dir.path):
+					with os.scandir(width_dir.path) as it:
+						paths.extend(pathlib.Path(entry.path) for entry in it if entry.name.endswith("_0.png") and entry.is_file())
+		return paths
+	# PIL decodes and encodes without holding the GIL, so letters are read on threads in parallel
+	data = await asyncio.gather(*(
+		asyncio.to_thread(read_letter, path)
+		for path in await asyncio.to_thread(first_frame_paths)
+	))
 
 	await db.conn.executemany(
 		'''
@@ -438,7 +469,10 @@ async def _load_ready_letters(db: Database):
 		data
 	)
 
-async def _load_letter(db: Database, word: str, tile_type: int):
+# Keeps only the pixels set to the flood fill placeholder
+FLOOD_FILL_PLACEHOLDER_LUT = [0] * 128 + [255] + [0] * 127
+
+async def _load_letter(db: Database, word: str, tile_type: int, plates: list[Image.Image]):
 	'''Scrapes letters from a sprite.'''
 	logger = get_logger()
 
@@ -447,10 +481,6 @@ async def _load_letter(db: Database, word: str, tile_type: int):
 	# Get the number of rows
 	two_rows = len(chars) >= 4
 
-	# Background plates for type-2 text,
-	# in 1 bit per pixel depth
-	plates = [db.plate(None, i)[0].getchannel("A").convert("1") for i in range(3)]
-
 	# Maps each character to three bounding boxes + images
 	# (One box + image for each frame of animation)
 	# char_pos : [((x1, y1, x2, y2), Image), ...]
@@ -479,52 +509,51 @@ async def _load_letter(db: Database, word: str, tile_type: int):
 
 		# More than 1 bit per pixel is required for the flood fill
 		alpha = alpha.convert("L")
+		# Reused for every character's flood fill, instead of copying the sprite each time
+		clone = alpha.copy()
 		for i, char in enumerate(chars):
 			if skip:
 				skip = False
 				continue
 
-			while alpha.getpixel((x, y)) == 0:
-				if x == alpha.width - 1:
-					if two_rows and y == 6:
-						x = 0
-						y = 18
-					else:
-						break
-				else:
-					x += 1
+			# Seek the next letter to the right, moving on to the second row once the first is done
+			pixels = np.asarray(alpha)
+			found = np.flatnonzero(pixels[y, x:])
+			if found.size == 0 and two_rows and y == 6:
+				x = 0
+				y = 18
+				found = np.flatnonzero(pixels[y, x:])
+			if found.size == 0:
+				return
+			x += int(found[0])
+
 			# There's a letter at this position
-			else:
-				clone = alpha.copy()
-				ImageDraw.floodfill(clone, (x, y), 128) # 1 placeholder
-				clone = Image.eval(clone, lambda x: 255 if x == 128 else 0)
-				clone = clone.convert("1")
-
-				# Get bounds of character blob
-				x1, y1, x2, y2 = clone.getbbox() # type: ignore
-				# Run some checks
-				# # Too wide => Skip 2 characters (probably merged two chars)
-				# if x2 - x1 > (1.5 * alpha.width * (1 + two_rows) / len(chars)):
-				#     skip = True
-				#     alpha = ImageChops.difference(alpha, clone)
-				#     continue
-
-				# Too tall? Scrap the rest of the characters
-				if y2 - y1 > 1.5 * alpha.height / (1 + two_rows):
-					break
-
-				# too thin! bad letter.
-				if x2 - x1 <= 2:
-					alpha = ImageChops.difference(alpha, clone)
-					continue
-
-				# Remove character from sprite, push to char_sizes
-				alpha = ImageChops.difference(alpha, clone)
-				clone = clone.crop((x1, y1, x2, y2))
-				entry = ((x1, y1, x2, y2), clone)
-				char_sizes.setdefault((i, char), []).append(entry)
+			clone.paste(alpha)
+			ImageDraw.floodfill(clone, (x, y), 128) # 1 placeholder
+			letter = clone.point(FLOOD_FILL_PLACEHOLDER_LUT, "1")
+
+			# Get bounds of character blob
+			x1, y1, x2, y2 = letter.getbbox() # type: ignore
+			# Run some checks
+			# # Too wide => Skip 2 characters (probably merged two chars)
+			# if x2 - x1 > (1.5 * alpha.width * (1 + two_rows) / len(chars)):
+			#     skip = True
+			#     alpha = ImageChops.difference(alpha, letter)
+			#     continue
+
+			# Too tall? Scrap the rest of the characters
+			if y2 - y1 > 1.5 * alpha.height / (1 + two_rows):
+				break
+
+			# too thin! bad letter.
+			if x2 - x1 <= 2:
+				alpha = ImageChops.difference(alpha, letter)
 				continue
-			return
+
+			# Remove character from sprite, push to char_sizes
+			alpha = ImageChops.difference(alpha, letter)
+			entry = ((x1, y1, x2, y2), letter.crop((x1, y1, x2, y2)))
+			char_sizes.setdefault((i, char), []).append(entry)
 
 	results = []
 	for (char_idx, char), entries in char_sizes.items():
@@ -546,7 +575,7 @@ async def _load_letter(db: Database, word: str, tile_type: int):
 				buf = io.BytesIO()
 				frame.save(buf, format="PNG")
 				blobs.append(buf.getvalue())
-			logger.debug(f"Loading letter {char} in {mode} with width {width} and sprite cnt {len(blobs)}. Char idx {char_idx} of word {word}.")
+			logger.debug("Loading letter %s in %s with width %s and sprite cnt %s. Char idx %s of word %s.", char, mode, width, len(blobs), char_idx, word)
 			results.append([mode, char, width, *blobs])
 
 	cur = await db.conn.executemany(
@@ -560,21 +589,29 @@ async def _load_letter(db: Database, word: str, tile_type: int):
 
 @with_load_flag(flag="letters.vanilla", description="vanilla letters")
 async def load_vanilla_letters(db: Database):
-	ignored = json.load(open("config/letterignore.json"))
-	for row in await db.conn.fetchall(
-		f'''
-		SELECT * FROM tiles
+	with open("config/letterignore.json") as f:
+		ignored = frozenset(json.load(f))
+
+	# Background plates for type-2 text,
+	# in 1 bit per pixel depth.
+	# They're the same for every word, so they're only read once
+	plates = [db.plate(None, i)[0].getchannel("A").convert("1") for i in range(3)]
+
+	for sprite, text_type in await db.conn.fetchall(
+		'''
+		SELECT sprite, text_type FROM tiles
 		WHERE sprite LIKE "text\\___%" ESCAPE "\\"
-				AND source == {repr(constants.BABA_WORLD)}
+				AND source == ?
 				AND text_direction IS NULL;
-		'''
+		''',
+		constants.BABA_WORLD
 	):
-		data = TileData.from_row(row)
-		if data.sprite not in ignored:
+		if sprite not in ignored:
 			await _load_letter(
 				db,
-				data.sprite,
-				data.text_type # type: ignore
+				sprite,
+				text_type,
+				plates
 			)
 
 	await _load_ready_letters(db)
@@ -595,8 +632,20 @@ async def load(db: Database, force_flags: list[str] = []):
 	logger = get_logger()
 	logger.info("Loading...")
 
-	for loader in loaders:
-		force_load = any(fnmatch.fnmatch(loader.flag, forced_flag) for forced_flag in force_flags)
-		await loader(db, skip_flag_check=force_load)
+	# Flags are read once for all loaders, and written at the end.
+	# Loaders that finished before one fails still have their flag written
+	set_flags = {row[0] for row in await db.conn.fetchall("SELECT flag FROM load_flags")}
+	previously_set_flags = set(set_flags)
+	try:
+		for loader in loaders:
+			force_load = any(fnmatch.fnmatch(loader.flag, forced_flag) for forced_flag in force_flags)
+			await loader(db, set_flags=set_flags, skip_flag_check=force_load)
+	finally:
+		await db.conn.executemany(
+			'''
+			INSERT OR IGNORE INTO load_flags VALUES (?)
+			''',
+			[(flag,) for flag in set_flags - previously_set_flags]
+		)
 
 	logger.info("Loading done!")
@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import collections
+import dataclasses
+import functools
+import heapq
+import io
+import logging
+import os
+import pathlib
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+INPUT_HASH_SIZE = 16 # bytes
+
+@dataclasses.dataclass(frozen=True)
+class GeneratedTiles:
+	input_hash: int
+	size: int
+	mtime: float = dataclasses.field(repr=False) # of the file, which is also when it was generated
+	max_life: dataclasses.InitVar[timedelta]
+	generated_at: datetime = dataclasses.field(init=False, compare=False)
+	result_url_hash: str = dataclasses.field(init=False, repr=False, compare=False)
+	expires_at: float = dataclasses.field(init=False, repr=False, compare=False) # in time.monotonic() seconds
+
+	def __post_init__(self, max_life: timedelta):
+		# Computed once, as they're used on every response. Set through object, since the dataclass is frozen.
+		object.__setattr__(self, "generated_at", datetime.fromtimestamp(self.mtime))
+		object.__setattr__(self, "result_url_hash", GeneratedTiles.input_hash_to_result_url_hash(self.input_hash))
+		# Results adopted from a previous run or another worker are already partway through their life
+		age = time.time() - self.mtime
+		object.__setattr__(self, "expires_at", time.monotonic() + max_life.total_seconds() - age)
+
+	@property
+	def file_name(self) -> str:
+		return f"{self.result_url_hash}.gif"
+
+	def __hash__(self):
+		return self.input_hash
+
+	@staticmethod
+	def input_hash_to_result_url_hash(input_hash: int) -> str:
+		input_hash_bytes = input_hash.to_bytes(length=INPUT_HASH_SIZE, byteorder="big")
+		# Padding is left out, as the length is always the same
+		return base64.urlsafe_b64encode(input_hash_bytes).rstrip(b"=").decode("ascii")
+
+	@staticmethod
+	@functools.lru_cache(maxsize=4096) # browsers tend to request the same result repeatedly
+	def result_url_hash_to_input_hash(result_url_hash: str):
+		hash_bytes = base64.urlsafe_b64decode(result_url_hash + "=" * (-len(result_url_hash) % 4))
+		if len(hash_bytes) != INPUT_HASH_SIZE:
+			raise ValueError(f"Expected a hash of {INPUT_HASH_SIZE} bytes, got {len(hash_bytes)}")
+		input_hash = int.from_bytes(hash_bytes, byteorder="big")
+		return input_hash
+
+class ResultsCache:
+	"""
+	Generated results, stored as files in `path`.
+
+	Results are removed once they are older than `max_life`,
+	or earlier if there are more than `max_count` of them or their total size goes over `max_size` (least recently used first).
+	"""
+
+	def __init__(self, path: pathlib.Path, max_life: timedelta, max_count: int, max_size: int, logger: logging.Logger) -> None:
+		self.path: pathlib.Path = path
+		self.max_life: timedelta = max_life
+		self.max_count: int = max_count
+		self.max_size: int = max_size
+		self.logger: logging.Logger = logger
+
+		# Ordered from least to most recently used
+		self.map: collections.OrderedDict[int, GeneratedTiles] = collections.OrderedDict()
+		self.total_size: int = 0
+		self.stats: collections.Counter[str] = collections.Counter(hits=0, misses=0, deduplicated=0, evictions=0)
+		# Min-heap of (expires_at, input_hash)
+		self.scheduled_to_remove: list[tuple[float, int]] = []
+		# Set when something expires before what remove_scheduled_loop() is waiting for, or was evicted
+		self.rescheduled: asyncio.Event = asyncio.Event()
+		# Evicted results whose files remove_scheduled_loop() hasn't removed yet
+		self.evicted: list[GeneratedTiles] = []
+		# Results being generated right now
+		self.in_flight: dict[int, asyncio.Task[GeneratedTiles]] = {}
+
+	def __len__(self) -> int:
+		return len(self.map)
+
+	def _path_of(self, input_hash: int) -> pathlib.Path:
+		return self.path / f"{GeneratedTiles.input_hash_to_result_url_hash(input_hash)}.gif"
+
+	def prepare(self):
+		"""Adopts results left over from a previous run, so their URLs keep working until they expire."""
+
+		self.path.mkdir(parents=True, exist_ok=True)
+
+		now = time.time()
+		leftovers = []
+		for path in self.path.glob("*.gif"):
+			try:
+				input_hash = GeneratedTiles.result_url_hash_to_input_hash(path.stem)
+			except ValueError: # not named after a hash, or from a version with a different hash size
+				input_hash = None
+
+			generated_tiles = None
+			if input_hash is not None and GeneratedTiles.input_hash_to_result_url_hash(input_hash) == path.stem:
+				generated_tiles = self._read_file(input_hash, now)
+
+			if generated_tiles is None:
+				path.unlink(missing_ok=True)
+				continue
+
+			leftovers.append(generated_tiles)
+
+		# Oldest first, the closest we have to least recently used
+		for generated_tiles in sorted(leftovers, key=lambda generated_tiles: generated_tiles.mtime):
+			self._add(generated_tiles)
+
+		if leftovers:
+			self.logger.info("Adopted %d result(s) from a previous run", len(self.map))
+
+	def get(self, input_hash: int | None) -> GeneratedTiles | None:
+		if input_hash is None:
+			return None
+
+		generated_tiles = self.map.get(input_hash, None)
+		if generated_tiles is not None:
+			# Other workers sharing the directory may have removed the file, or replaced it with a newer one
+			try:
+				mtime = os.stat(self.path / generated_tiles.file_name).st_mtime
+			except FileNotFoundError:
+				mtime = None
+			if mtime == generated_tiles.mtime and generated_tiles.expires_at > time.monotonic():
+				self.map.move_to_end(input_hash)
+				return generated_tiles
+
+			self._forget(input_hash)
+			if mtime is None:
+				return None
+		elif input_hash in self.in_flight:
+			# store() adds it once it's written
+			return None
+
+		# Other workers serving from the same directory may have generated it
+		generated_tiles = self._read_file(input_hash, time.time())
+		if generated_tiles is not None:
+			self._add(generated_tiles)
+		return generated_tiles
+
+	def _read_file(self, input_hash: int, now: float) -> GeneratedTiles | None:
+		"""The result in the file for `input_hash`, if there's one still alive at `now` (in time.time() seconds)."""
+		try:
+			stat = self._path_of(input_hash).stat()
+		except FileNotFoundError:
+			return None
+
+		if now - stat.st_mtime >= self.max_life.total_seconds():
+			return None
+		return GeneratedTiles(input_hash=input_hash, size=stat.st_size, mtime=stat.st_mtime, max_life=self.max_life)
+
+	async def generate(self, input_hash: int, render: Callable[[], Awaitable[io.BytesIO]]) -> GeneratedTiles:
+		"""
+		Stores the output of `render()`.
+
+		Concurrent calls for the same input wait for the first one to finish, instead of rendering it again.
+		"""
+
+		task = self.in_flight.get(input_hash, None)
+		if task is None:
+			task = asyncio.create_task(self._render_and_store(input_hash, render))
+			self.in_flight[input_hash] = task
+			task.add_done_callback(lambda task: self._forget_in_flight(input_hash, task))
+		else:
+			self.stats["deduplicated"] += 1
+
+		# Shielded, so one client going away doesn't cancel the render for everyone else waiting on it
+		return await asyncio.shield(task)
+
+	async def _render_and_store(self, input_hash: int, render: Callable[[], Awaitable[io.BytesIO]]) -> GeneratedTiles:
+		# Counted here, so requests waiting on someone else's render aren't misses
+		self.stats["misses"] += 1
+		buffer = await render()
+		# Written straight from the buffer's memory, instead of copying it into bytes first
+		with buffer.getbuffer() as blob:
+			return await self.store(input_hash, blob)
+
+	def _forget_in_flight(self, input_hash: int, task: asyncio.Task[GeneratedTiles]):
+		del self.in_flight[input_hash]
+		if not task.cancelled():
+			# Marks the exception as retrieved, in case everyone waiting on it went away
+			task.exception()
+
+	async def store(self, input_hash: int, blob: bytes | memoryview) -> GeneratedTiles:
+		mtime = await asyncio.to_thread(self._write_file, self._path_of(input_hash), blob)
+		# With the file's own mtime, so get() recognizes it as the same file
+		generated_tiles = GeneratedTiles(input_hash=input_hash, size=len(blob), mtime=mtime, max_life=self.max_life)
+		self._add(generated_tiles)
+		return generated_tiles
+
+	@staticmethod
+	def _write_file(path: pathlib.Path, blob: bytes | memoryview) -> float:
+		# Written under a different name first, so a partially written file is never served
+		temp_path = path.with_name(f".{path.name}.{os.getpid()}")
+		temp_path.write_bytes(blob)
+		mtime = temp_path.stat().st_mtime
+		temp_path.replace(path)
+		return mtime
+
+	def _add(self, generated_tiles: GeneratedTiles):
+		replaced = self.map.get(generated_tiles.input_hash, None)
+		if replaced is not None:
+			self.total_size -= replaced.size
+			self.map.move_to_end(generated_tiles.input_hash)
+		self.map[generated_tiles.input_hash] = generated_tiles
+		self.total_size += generated_tiles.size
+		# Scheduled right away, as results may be served without going through this app (see WEBAPP.nginx.conf)
+		if not self.scheduled_to_remove or generated_tiles.expires_at < self.scheduled_to_remove[0][0]:
+			self.rescheduled.set()
+		heapq.heappush(self.scheduled_to_remove, (generated_tiles.expires_at, generated_tiles.input_hash))
+
+		# Evict the least recently used results, but always keep the one just stored.
+		# Other workers sharing the directory see their files gone on their next get(), and render them again
+		while (len(self.map) > self.max_count or self.total_size > self.max_size) and len(self.map) > 1:
+			evicted = self._forget(next(iter(self.map)))
+			self.stats["evictions"] += 1
+			self.logger.info("Evicting %r", evicted)
+			self.evicted.append(evicted)
+			self.rescheduled.set()
+
+	def _forget(self, input_hash: int) -> GeneratedTiles:
+		generated_tiles = self.map.pop(input_hash)
+		self.total_size -= generated_tiles.size
+		return generated_tiles
+
+	def _remove_expired_files(self, input_hashes: list[int]):
+		now = time.time()
+		max_life = self.max_life.total_seconds()
+		for input_hash in input_hashes:
+			# Unless it was generated again in the meantime, here or by another worker
+			self._remove_file_if(self._path_of(input_hash), lambda mtime: now - mtime >= max_life)
+
+	def _remove_evicted_files(self, evicted: list[GeneratedTiles]):
+		for generated_tiles in evicted:
+			# Only the file that was evicted, not a newer one generated since
+			self._remove_file_if(self.path / generated_tiles.file_name, lambda mtime: mtime == generated_tiles.mtime)
+
+	@staticmethod
+	def _remove_file_if(path: pathlib.Path, should_remove: Callable[[float], bool]) -> bool:
+		"""Removes the file at `path` if `should_remove(its mtime)`, even if another worker replaces it meanwhile."""
+		try:
+			if not should_remove(path.stat().st_mtime):
+				return False
+			# Moved out of the way before checking again, so a file another worker wrote right after the first
+			# check is never removed
+			trash_path = path.with_name(f".{path.name}.{os.getpid()}.removed")
+			path.replace(trash_path)
+		except FileNotFoundError:
+			return False
+
+		if should_remove(trash_path.stat().st_mtime):
+			trash_path.unlink()
+			return True
+		# Put back, unless an even newer one took its place. Until then it's missing, which at worst means rendering it again
+		try:
+			os.link(trash_path, path)
+		except FileExistsError:
+			pass
+		trash_path.unlink()
+		return False
+
+	async def remove_scheduled_loop(self):
+		while True:
+			# Cleared before looking for work rather than after, so whatever is set while files are being removed
+			# isn't missed
+			self.rescheduled.clear()
+			now = time.monotonic()
+
+			expired: list[int] = []
+			while self.scheduled_to_remove and self.scheduled_to_remove[0][0] <= now:
+				_, input_hash = heapq.heappop(self.scheduled_to_remove)
+				generated_tiles = self.map.get(input_hash, None)
+				# The entry may have been replaced by a newer result with the same hash
+				if generated_tiles is not None and generated_tiles.expires_at <= now:
+					self.logger.info("Removing %r", generated_tiles)
+					self._forget(input_hash)
+				# The file may be another worker's, or have been adopted again
+				expired.append(input_hash)
+
+			if expired:
+				# Many results can expire at once, so their files are removed on a thread
+				await asyncio.to_thread(self._remove_expired_files, expired)
+				now = time.monotonic()
+			if self.evicted:
+				evicted, self.evicted = self.evicted, []
+				await asyncio.to_thread(self._remove_evicted_files, evicted)
+				now = time.monotonic()
+
+			# Results adopted from disk may have less life left than anything already scheduled,
+			# so pushing one of those earlier than the next expiry wakes the loop up
+			timeout = self.scheduled_to_remove[0][0] - now if self.scheduled_to_remove else None
+			try:
+				await asyncio.wait_for(self.rescheduled.wait(), timeout)
+			except asyncio.TimeoutError: # not the builtin TimeoutError before Python 3.11
+				pass
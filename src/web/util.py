@@ -1,10 +1,9 @@
 from __future__ import annotations
 
-import re
 import io
+from collections import defaultdict
 from time import time
 from io import BytesIO
-from os import listdir
 from dataclasses import dataclass
 
 import lark
@@ -13,6 +12,7 @@ from lark.tree import Tree
 
 from .. import constants, errors
 from ..tile import RawTile
+from ..utils import BUILTIN_EMOJI, CLEANUP_REGEXP, FLAG_REGEXPS, TOKEN_VALUE, match_mistake, palette_names
 
 from .context import get_database, get_operation_macros, get_variant_handlers, get_renderer, get_lark_parser
 
@@ -100,18 +100,10 @@ def normalize_objects(objects: str):
 	tiles = objects.lower().strip()
 
 	# replace emoji with their :text: representation
-	builtin_emoji = {
-		ord("\u24dc"): ":m:", # lower case circled m
-		ord("\u24c2"): ":m:", # upper case circled m
-		ord("\U0001f199"): ":up:", # up! emoji
-		ord("\U0001f637"): ":mask:", # mask emoji
-		ord("\ufe0f"): None
-	}
-	tiles = tiles.translate(builtin_emoji)
-	tiles = re.sub(r'<a?(:[a-zA-Z0-9_]{2,32}:)\d{1,21}>', r'\1', tiles)
-
-	# ignore all these
-	tiles = tiles.replace("```\n", "").replace("\\", "").replace("`", "")
+	if not tiles.isascii(): # the builtin emoji are all outside of it
+		tiles = tiles.translate(BUILTIN_EMOJI)
+	# custom emoji too, while removing everything that's ignored
+	tiles = CLEANUP_REGEXP.sub(lambda match: match.group(1) or "", tiles)
 
 	return tiles
 
@@ -126,43 +118,33 @@ async def render_tiles__ROBOT(
 	objects = objects.replace("|", "")
 
 	# Handle flags *first*, before even splitting
-	flag_patterns = (
-		r"(?:^|\s)(?:--background|-b)(?:=(\d)/(\d))?(?:$|\s)",
-		r"(?:^|\s)(?:--palette=|-p=|palette:)(\w+)(?:$|\s)",
-		r"(?:^|\s)(?:--raw|-r)(?:=([a-zA-Z_0-9]+))?(?:$|\s)",
-		r"(?:^|\s)(?:--letter|-l)(?:$|\s)",
-		r"(?:^|\s)(?:(--delay=|-d=)(\d+))(?:$|\s)",
-		r"(?:^|\s)(?:(--frames=|-f=)(\d))(?:$|\s)",
-	)
 	background = None
-	for match in re.finditer(flag_patterns[0], tiles):
+	for match in FLAG_REGEXPS[0].finditer(tiles):
 		if match.group(1) is not None:
 			tx, ty = int(match.group(1)), int(match.group(2))
 			background = tx, ty
 		else:
 			background = (0, 4)
 	palette = "default"
-	for match in re.finditer(flag_patterns[1], tiles):
+	for match in FLAG_REGEXPS[1].finditer(tiles):
 		palette = match.group(1)
 	raw_output = False
 	raw_name = ""
-	for match in re.finditer(flag_patterns[2], tiles):
+	for match in FLAG_REGEXPS[2].finditer(tiles):
 		raw_output = True
 		if match.group(1) is not None:
 			raw_name = match.group(1)
-	default_to_letters = False
-	for match in re.finditer(flag_patterns[3], tiles):
-		default_to_letters = True
+	default_to_letters = FLAG_REGEXPS[3].search(tiles) is not None
 	delay = 200
-	for match in re.finditer(flag_patterns[4], tiles):
+	for match in FLAG_REGEXPS[4].finditer(tiles):
 		delay = int(match.group(2))
 	frame_count = 3
-	for match in re.finditer(flag_patterns[5], tiles):
+	for match in FLAG_REGEXPS[5].finditer(tiles):
 		frame_count = int(match.group(2))
 
 	# Clean up
-	for pattern in flag_patterns:
-		tiles = re.sub(pattern, " ", tiles)
+	for flag_regexp in FLAG_REGEXPS:
+		tiles = flag_regexp.sub(" ", tiles)
 
 	# read from file if nothing (beyond flags) is provided
 	# TODO(netux): move to ROBOT utils
@@ -238,7 +220,7 @@ async def render_tiles(
 			raise errors.WebappUserError("The provided background color is invalid.")
 			# return await ctx.error("The provided background color is invalid.")
 
-	if f"{options.palette}.png" not in listdir("data/palettes"):
+	if f"{options.palette}.png" not in palette_names():
 		raise errors.WebappUserError(f"Could not find a palette with name \"{options.palette}\".")
 		# return await ctx.error(f"Could not find a palette with name \"{palette}\".")
 
@@ -253,8 +235,33 @@ async def render_tiles(
 	# Split input into lines
 	rows = tiles.splitlines()
 
-	expanded_tiles: dict[tuple[int, int, int], list[RawTile]] = {}
+	expanded_tiles: defaultdict[tuple[int, int, int], list[RawTile]] = defaultdict(list)
 	previous_tile: list[RawTile] = []
+	# Objects after handle_text_mode, by (object, text delta)
+	text_mode_cache: dict[tuple[str, int], str] = {}
+	def handle_text_mode(obj: str, text_delta: int) -> str:
+		'''RETURNS COPY'''
+		if text_delta == 0:
+			return obj
+		key = obj, text_delta
+		if key in text_mode_cache:
+			return text_mode_cache[key]
+		if text_delta > 0:
+			for _ in range(text_delta):
+				if obj.startswith("tile_"):
+					obj = obj[5:]
+				else:
+					obj = f"text_{obj}"
+		else:
+			for _ in range(text_delta):
+				if obj.startswith("text_"):
+					obj = obj[5:]
+				else:
+					raise RuntimeError("this should never happen")
+					# TODO: handle this explicitly
+		text_mode_cache[key] = obj
+		return obj
+
 	# Do the bulk of the parsing here:
 	for y, row in enumerate(rows):
 		x = 0
@@ -267,27 +274,7 @@ async def render_tiles(
 			raise errors.WebappUserError(f"Invalid character `{e.char}` in row {y}, around `... {row[e.column - 5: e.column + 5]} ...`")
 			# return await ctx.error(f"Invalid character `{e.char}` in row {y}, around `... {row[e.column - 5: e.column + 5]} ...`")
 		except lark.UnexpectedToken as e:
-			mistake_kind = e.match_examples(
-				lark_parser.parse,
-				{
-					"unclosed": [
-						"(baba",
-						"[this ",
-						"\"rule",
-					],
-					"missing": [
-						":red",
-						"baba :red",
-						"&baba",
-						"baba& keke",
-						">baba",
-						"baba> keke"
-					],
-					"variant": [
-						"baba: keke",
-					]
-				}
-			)
+			mistake_kind = match_mistake(e, lark_parser)
 			around = f"`... {row[e.column - 5 : e.column + 5]} ...`"
 			if mistake_kind == "unclosed":
 				raise errors.WebappUserError(f"Unclosed brackets or quotes! Expected them to close around {around}.")
@@ -321,9 +308,7 @@ async def render_tiles(
 			if line.data in ("text_block", "tile_block", "any_block"):
 				*stacks, variants = line.children
 				variants: Tree
-				for variant in variants.children:
-					variant: Token
-					line_variants.append(variant.value)
+				line_variants.extend(map(TOKEN_VALUE, variants.children))
 			else:
 				stacks = line.children
 
@@ -340,10 +325,7 @@ async def render_tiles(
 
 						blob_text_mode: bool | None = None
 
-						stack_variants = []
-						for variant in variants.children:
-							variant: Token
-							stack_variants.append(variant.value)
+						stack_variants = list(map(TOKEN_VALUE, variants.children))
 						if blob.data == "text_blob":
 							blob_text_mode = True
 						elif blob.data == "tile_blob":
@@ -354,6 +336,11 @@ async def render_tiles(
 					blobs = [(None, [], stack)]
 
 				for blob_text_mode, stack_variants, blob in blobs:
+					extra_variants = stack_variants + line_variants
+					# The same for every tile in the blob
+					text_delta = -1 if blob_text_mode is False else blob_text_mode or 0
+					text_delta += -1 if line_text_mode is False else line_text_mode or 0
+					text_delta += is_rule
 					for process in blob.children:
 						process: Tree
 						t = 0
@@ -367,41 +354,10 @@ async def render_tiles(
 						obj = object.value
 						variants: Tree
 
-						final_variants: list[str] = [
-							var.value
-							for var in variants.children
-						]
-
-						def append_extra_variants(final_variants: list[str]):
-							'''IN PLACE'''
-							final_variants.extend(stack_variants)
-							final_variants.extend(line_variants)
-
-						def handle_text_mode(obj: str) -> str:
-							'''RETURNS COPY'''
-							text_delta = -1 if blob_text_mode is False else blob_text_mode or 0
-							text_delta += -1 if line_text_mode is False else line_text_mode or 0
-							text_delta += is_rule
-							if text_delta == 0:
-								return obj
-							elif text_delta > 0:
-								for _ in range(text_delta):
-									if obj.startswith("tile_"):
-										obj = obj[5:]
-									else:
-										obj = f"text_{obj}"
-								return obj
-							else:
-								for _ in range(text_delta):
-									if obj.startswith("text_"):
-										obj = obj[5:]
-									else:
-										raise RuntimeError("this should never happen")
-										# TODO: handle this explicitly
-								return obj
-
-						obj = handle_text_mode(obj)
-						append_extra_variants(final_variants)
+						final_variants: list[str] = list(map(TOKEN_VALUE, variants.children))
+
+						obj = handle_text_mode(obj, text_delta)
+						final_variants += extra_variants
 
 						dx = dy = 0
 						temp_tile: list[RawTile] = [RawTile(obj, final_variants, ephemeral=False)]
@@ -421,15 +377,15 @@ async def render_tiles(
 									previous_tile[-1:] = [still]
 
 								for dt in range(count):
-									expanded_tiles.setdefault((x + dx, y + dy, t + dt), []).append(still)
+									expanded_tiles[x + dx, y + dy, t + dt].append(still)
 
 								object, variants = unit.children
 								object: Token
 								obj = object.value
-								obj = handle_text_mode(obj)
+								obj = handle_text_mode(obj, text_delta)
 
-								final_variants = [var.value for var in variants.children]
-								append_extra_variants(final_variants)
+								final_variants = list(map(TOKEN_VALUE, variants.children))
+								final_variants += extra_variants
 
 								temp_tile.append(
 									RawTile(
@@ -458,31 +414,32 @@ async def render_tiles(
 								t += dt
 						# somewhat monadic behavior
 						if not last_hack:
-							expanded_tiles.setdefault((x + dx, y + dy, t), []).extend(temp_tile[:])
+							expanded_tiles[x + dx, y + dy, t].extend(temp_tile)
 				x += 1
 
 	# Get the dimensions of the grid
-	width = max(expanded_tiles, key=lambda pos: pos[0])[0] + 1
-	height = max(expanded_tiles, key=lambda pos: pos[1])[1] + 1
-	duration = 1 + max(t for _, _, t in expanded_tiles)
+	max_x = max_y = max_t = 0
+	for x, y, t in expanded_tiles:
+		if x > max_x:
+			max_x = x
+		if y > max_y:
+			max_y = y
+		if t > max_t:
+			max_t = t
+	width, height, duration = max_x + 1, max_y + 1, max_t + 1
 
 	temporal_maxima: dict[tuple[int, int], tuple[int, list[RawTile]]] = {}
 	for (x, y, t), tile_stack in expanded_tiles.items():
-		if (x, y) in temporal_maxima and temporal_maxima[x, y][0] < t:
-			persistent = [tile for tile in tile_stack if not tile.ephemeral]
-			if len(persistent) != 0:
-				temporal_maxima[x, y] = t, persistent
-		elif (x, y) not in temporal_maxima:
+		maximum = temporal_maxima.get((x, y))
+		if maximum is None or maximum[0] < t:
 			persistent = [tile for tile in tile_stack if not tile.ephemeral]
 			if len(persistent) != 0:
 				temporal_maxima[x, y] = t, persistent
 	# Pad the grid across time
 	for (x, y), (t_star, tile_stack) in temporal_maxima.items():
-		for t in range(t_star, duration - 1):
-			if (x, y, t + 1) not in expanded_tiles:
-				expanded_tiles[x, y, t + 1] = tile_stack
-			else:
-				expanded_tiles[x, y, t + 1] = tile_stack + expanded_tiles[x, y, t + 1]
+		for t in range(t_star + 1, duration):
+			later = expanded_tiles.get((x, y, t))
+			expanded_tiles[x, y, t] = tile_stack if later is None else tile_stack + later
 
 	# filter out blanks before rendering
 	expanded_tiles = {index: [tile for tile in stack if not tile.is_empty] for index, stack in expanded_tiles.items()}
@@ -542,12 +499,13 @@ async def render_tiles(
 	except errors.TileNotFound as e:
 		word = e.args[0]
 		name = word.name
-		if word.name.startswith("tile_") and await database.tile(name[5:]) is not None:
-			raise errors.WebappUserError(f"The tile `{name}` could not be found. Perhaps you meant `{name[5:]}`?")
-			# return await ctx.error(f"The tile `{name}` could not be found. Perhaps you meant `{name[5:]}`?")
-		if await database.tile("text_" + name) is not None:
-			raise errors.WebappUserError(f"The tile `{name}` could not be found. Perhaps you meant `{'text_' + name}`?")
-			# return await ctx.error(f"The tile `{name}` could not be found. Perhaps you meant `{'text_' + name}`?")
+		suggestions = [name[5:]] if name.startswith("tile_") else []
+		suggestions.append("text_" + name)
+		existing = await database.existing_tiles(suggestions)
+		for suggestion in suggestions:
+			if suggestion in existing:
+				raise errors.WebappUserError(f"The tile `{name}` could not be found. Perhaps you meant `{suggestion}`?")
+				# return await ctx.error(f"The tile `{name}` could not be found. Perhaps you meant `{suggestion}`?")
 		raise errors.WebappUserError(f"The tile `{name}` could not be found.")
 		# return await ctx.error(f"The tile `{name}` could not be found.")
 	except errors.BadTileProperty as e: